@@ -9,10 +9,11 @@ __author__ = 'dayling'
 from multiprocessing import Process, Queue
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 from subprocess import check_output, STDOUT
-from heartbeat import Heartbeat
+from heartbeat import Heartbeat, monotonic
 from data_writer import DataWriter
 from tcp_client import TCPClient
 import time
+import itertools
 import logging
 import json
 import thread
@@ -84,6 +85,8 @@ class Client(object):
                                                         self.kill_sig))
         self.dw_process.daemon = True
         self.dw_process_pid = None
+        # shared by the writer and monitor, the server logs gaps and restarts
+        self.tcp_seq = itertools.count(1)
 
     def start_client(self):
         """
@@ -109,10 +112,11 @@ class Client(object):
                 except Queue2.Empty:
                     continue
                 self.tcp.send_data(json.JSONEncoder().encode(
-                    {self.client_id:{"operation_time": dw_res[0],
-                                     "file_size": dw_res[1],
-                                     "chunk_size": self.chunk_size,
-                                     "write_speed": dw_res[2]}}))
+                    {self.client_id: self.stamp(
+                        {"operation_time": dw_res[0],
+                         "file_size": dw_res[1],
+                         "chunk_size": self.chunk_size,
+                         "write_speed": dw_res[2]})}))
                 logging.info(dw_res)
         except KeyboardInterrupt:
             pass
@@ -137,11 +141,22 @@ class Client(object):
                                               '%cpu,%mem'], stderr=STDOUT)
                     cpu, mem = monitor_m.splitlines()[1].strip().split()
                     self.tcp.send_data(json.JSONEncoder().encode(
-                        {self.client_id+'_Performance': {"cpu": cpu,
-                                                         "mem": mem}}))
+                        {self.client_id+'_Performance': self.stamp(
+                            {"cpu": cpu, "mem": mem})}))
         except KeyboardInterrupt:
             pass
 
+    def stamp(self, record):
+        """
+        add the sequence number and monotonic send time to a record so the
+        server can place it on its own timeline
+        :param record: dict, record to send to the server
+        :return: dict, the same record
+        """
+        record["seq"] = next(self.tcp_seq)
+        record["sent"] = monotonic()
+        return record
+
     def run_timer(self):
         """
         run timer
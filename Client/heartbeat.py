@@ -1,12 +1,60 @@
 """
 Module that encapsulates the multicast heartbeat class
-Sends a JSON blob containing the client id and the current time
+Sends a JSON blob containing the client id, a sequence number, the current
+time and a monotonic send time the server uses to estimate the clock offset
 """
 __author__ = 'dayling'
 
 import socket
 import time
 import json
+import ctypes
+import ctypes.util
+import platform
+
+# clock ids for clock_gettime, the value differs per platform
+CLOCK_MONOTONIC = {'Linux': 1, 'Darwin': 6}
+
+
+class Timespec(ctypes.Structure):
+    """struct timespec as returned by clock_gettime"""
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def clock_gettime_monotonic():
+    """Build a monotonic clock reading CLOCK_MONOTONIC from libc
+    :return: function returning seconds as a float, None if unavailable
+    """
+    clock_id = CLOCK_MONOTONIC.get(platform.system())
+    libc_name = ctypes.util.find_library('c')
+    if clock_id is None or libc_name is None:
+        return None
+    try:
+        clock_gettime = ctypes.CDLL(libc_name, use_errno=True).clock_gettime
+    except (OSError, AttributeError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+
+    def monotonic_time():
+        """
+        :return: float, seconds from an arbitrary point, never steps back
+        """
+        # one per call, the writer and monitor threads both stamp records
+        spec = Timespec()
+        if clock_gettime(clock_id, ctypes.byref(spec)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "clock_gettime failed")
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+    return monotonic_time
+
+
+# Python 2 has no time.monotonic, read the OS clock directly instead. Only
+# if neither works the wall clock is used, a step or slew of the client
+# clock then shows up as a jump in the estimated offset
+monotonic = getattr(time, 'monotonic', None) or clock_gettime_monotonic()
+MONOTONIC = monotonic is not None
+if not MONOTONIC:
+    monotonic = time.time
 
 
 class Heartbeat(socket.socket):
@@ -32,15 +80,18 @@ class Heartbeat(socket.socket):
         """
         start the heartbeat
         """
+        seq = 0
         try:
             while kill_sig.empty():
-                # dict to use as json blob containing id and time
-                json_blob = {"id": self.client_id, "time": time.asctime()}
-                # Keep sending the heartbeat until something fails
-                while self.sender(json.JSONEncoder()
-                                  .encode({"heartbeat": json_blob})):
-                    json_blob["time"] = time.time()
-                    time.sleep(self.send_interval)
+                seq += 1
+                # dict to use as json blob containing id, sequence and time
+                # stamped as late as possible before the send
+                json_blob = {"id": self.client_id, "seq": seq,
+                             "time": time.time(), "sent": monotonic(),
+                             "monotonic": MONOTONIC}
+                self.sender(json.JSONEncoder()
+                            .encode({"heartbeat": json_blob}))
+                time.sleep(self.send_interval)
             raise KeyboardInterrupt
         except KeyboardInterrupt:
             print "\rClosing Heartbeat UDP socket"
@@ -3,4 +3,5 @@ Server modules
 """
 __author__ = 'dayling'
 
-__all__ = ['hb_listener', 'tcp_server', 'server']
+__all__ = ['hb_listener', 'tcp_server', 'clock_sync', 'retention',
+           'server']
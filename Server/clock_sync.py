@@ -0,0 +1,182 @@
+"""
+Module containing the ClockEstimator class used to align client timestamps
+with the server clock.
+Clients stamp every heartbeat with a sequence number and a monotonic send
+time, the server stamps it with a receive time. From those pairs an NTP style
+clock filter keeps the lowest delay sample of each recent window and a least
+squares fit over those filtered samples gives the offset and drift of the
+client clock. Snapshots of the fit can later re-map stored timestamps with
+map_to_server.
+    The channel is one way, so the offset includes the minimum path delay.
+    Delays reported by the estimator are the excess over that minimum.
+"""
+__author__ = 'dayling'
+
+from collections import deque
+import threading
+
+
+def map_to_server(snapshots, sent, received=None):
+    """Map a client timestamp onto the server timeline with stored snapshots
+    of the clock model. The snapshot whose samples span sent is used, when
+    several do (the client restarted) the one mapping closest to received
+    :param snapshots: list of dicts, ClockEstimator.summary() snapshots
+    :param sent: float, client (monotonic) timestamp
+    :param received: float, server receive time, optional
+    :return: float, server time or None if no snapshot has an estimate
+    """
+    best = None
+    for snap in snapshots:
+        if snap.get("offset") is None:
+            continue
+        mapped = sent + snap["offset"] + \
+            snap["drift"] * (sent - snap["reference"])
+        outside = max(snap.get("first", sent) - sent,
+                      sent - snap.get("last", sent), 0)
+        miss = abs(received - mapped) if received is not None else 0
+        if best is None or (outside, miss) < best[0]:
+            best = ((outside, miss), mapped)
+    return best[1] if best else None
+
+
+class SequenceTracker(object):
+    """Counts lost and reordered messages from their sequence numbers
+    A jump back to 1, or further back than max_reorder, is taken as a restart
+    of the sender rather than reordering
+    :param max_reorder: int, how far back a late message can be
+    """
+
+    def __init__(self, max_reorder=8):
+        self.max_reorder = max_reorder
+        self.last_seq = None
+        self.lost = 0
+        self.reordered = 0
+        self.restarts = 0
+
+    def update(self, seq):
+        """Track the sequence number of the next message
+        :param seq: int, sequence number of the message
+        :return: bool, True if the sender restarted
+        """
+        last = self.last_seq
+        if last is not None and seq < last and \
+                (seq == 1 or last - seq > self.max_reorder):
+            self.restarts += 1
+            self.last_seq = seq
+            return True
+        if last is None or seq > last:
+            if last is not None:
+                self.lost += seq - last - 1
+            self.last_seq = seq
+        elif seq < last:
+            self.reordered += 1
+            # counted as lost when the later message arrived
+            if self.lost:
+                self.lost -= 1
+        return False
+
+    def summary(self):
+        """
+        :return: dict, lost/reordered/restarts counters
+        """
+        return {"lost": self.lost, "reordered": self.reordered,
+                "restarts": self.restarts}
+
+
+class ClockEstimator(object):
+    """Offset/drift estimator for a single client clock
+    Thread safe, samples can be added from one thread while another is
+    mapping timestamps
+    :param filter_size: int, number of recent samples the clock filter picks
+                        the minimum delay sample from
+    :param history: int, number of filtered samples used for the drift fit
+    A restart of the client heartbeat starts a new estimate, the samples from
+    before the restart are dropped
+    """
+
+    def __init__(self, filter_size=8, history=64):
+        self.recent = deque(maxlen=filter_size)
+        self.points = deque(maxlen=history)
+        self.lock = threading.Lock()
+        self.sequence = SequenceTracker(filter_size)
+        self.offset = None
+        self.drift = 0.0
+        self.reference = 0.0
+        self.samples = 0
+
+    def add_sample(self, seq, sent, received):
+        """Add a client send/server receive pair and refresh the estimate
+        :param seq: int, sequence number of the message, None if unknown
+        :param sent: float, client (monotonic) send time in seconds
+        :param received: float, server receive time in seconds
+        :return: None
+        """
+        with self.lock:
+            self.samples += 1
+            if seq is not None and self.sequence.update(seq):
+                self.recent.clear()
+                self.points.clear()
+                self.offset = None
+            sample = (sent, received - sent)
+            self.recent.append(sample)
+            # clock filter, the lowest delay sample is the least disturbed
+            # by queueing so only that one goes into the fit, on a tie the
+            # newest one so the fit keeps moving forward
+            best = min(self.recent, key=lambda point: (point[1], -point[0]))
+            if not self.points or self.points[-1] != best:
+                self.points.append(best)
+            self.fit()
+
+    def fit(self):
+        """Least squares fit of the filtered samples
+        Must be called with the lock held
+        :return: None
+        """
+        count = len(self.points)
+        # center on the mean send time to keep the float math precise
+        self.reference = sum(point[0] for point in self.points) / count
+        mean_diff = sum(point[1] for point in self.points) / count
+        var = sum((point[0] - self.reference) ** 2 for point in self.points)
+        if count < 2 or var == 0:
+            self.drift = 0.0
+        else:
+            self.drift = sum((point[0] - self.reference) *
+                             (point[1] - mean_diff)
+                             for point in self.points) / var
+        self.offset = mean_diff
+
+    def to_server(self, sent):
+        """Map a client timestamp onto the server timeline
+        :param sent: float, client (monotonic) timestamp
+        :return: float, server time or None if there are no samples yet
+        """
+        with self.lock:
+            if self.offset is None:
+                return None
+            return sent + self.offset + self.drift * (sent - self.reference)
+
+    def delay(self, sent, received):
+        """One way delay of a message in excess of the minimum path delay
+        :param sent: float, client (monotonic) send time
+        :param received: float, server receive time
+        :return: float, seconds or None if there are no samples yet
+        """
+        server_sent = self.to_server(sent)
+        if server_sent is None:
+            return None
+        return received - server_sent
+
+    def summary(self):
+        """Current clock model, suitable for storing with the samples and
+        for map_to_server
+        :return: dict
+        """
+        with self.lock:
+            summary = {"offset": self.offset, "drift": self.drift,
+                       "reference": self.reference, "samples": self.samples}
+            # span of client time the fit is valid for
+            if self.points:
+                summary["first"] = self.points[0][0]
+                summary["last"] = self.recent[-1][0]
+            summary.update(self.sequence.summary())
+            return summary
@@ -1,10 +1,12 @@
 """
 Module that creates a generic multicast UDP socket that uses a Queue to send
 data wherever it needs to go
+Each datagram is queued as (data, receive_time)
 """
 __author__ = 'dayling'
 
 import socket
+import time
 import logging
 
 
@@ -36,7 +38,8 @@ class HeartBeatListener(socket.socket):
         try:
             while True:
                 buf = self.recv(1024)
-                data_queue.put(buf)
+                # stamp before queueing so queue latency is not included
+                data_queue.put((buf, time.time()))
         except EnvironmentError as e_string:
             logging.warning("UDP socket failed to receive data: " +
                             e_string.message)
@@ -0,0 +1,551 @@
+"""
+Module containing the Retention class that keeps the server database bounded
+Raw records are kept under their own key ("<id>", "<id>_Performance") for a
+recent window. Older records are rolled into fixed interval buckets stored
+under "<key>_Tier<interval>" in a separate tier shelf, and each tier is
+rolled into the next, coarser one once it is older than its own retention.
+A bucket keeps, per numeric field, the count, min, max, sum and a log
+bucketed percentile sketch, so buckets can be merged without going back to
+the raw data.
+    Records are placed in time by "server_time" or "received", records
+    without either are never rolled up. Records stamped by the client are
+    re-mapped with the clock snapshots of "<id>_Clock" first, and held back
+    until a snapshot covers them or they are twice the raw window old.
+    Snapshots that cannot map any record still held raw are dropped.
+"""
+__author__ = 'dayling'
+
+import math
+import re
+import time
+import threading
+import logging
+from clock_sync import map_to_server
+
+# bookkeeping fields added by the client/server, not worth aggregating
+SKIP_FIELDS = ('seq', 'sent', 'received', 'server_time')
+# leading number plus optional unit, e.g. '1.2GB/s' or '52428800bytes/sec'
+NUMBER_UNIT = re.compile(r'^\s*([-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)'
+                         r'\s*([A-Za-z/]*)\s*$')
+UNIT_PREFIX = {'k': 1e3, 'K': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12}
+PERCENTILES = (50, 90, 99)
+# values closer to zero than this share a single sketch bin
+MIN_VALUE = 1e-9
+
+
+def to_number(value):
+    """Convert a record value to a float
+    :param value: record value, number or string with an optional unit
+    :return: float or None if the value is not a finite number
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, long, float)):
+        number = float(value)
+    elif isinstance(value, basestring):
+        match = NUMBER_UNIT.match(value)
+        if not match:
+            return None
+        number, unit = match.groups()
+        number = float(number) * UNIT_PREFIX.get(unit[:1], 1.0)
+    else:
+        return None
+    # json decodes Infinity and NaN, neither fits in a bucket
+    if math.isinf(number) or math.isnan(number):
+        return None
+    return number
+
+
+def earliest(first, second):
+    """
+    :param first: float or None
+    :param second: float or None
+    :return: the smaller of the two that is not None, None if both are
+    """
+    if first is None:
+        return second
+    if second is None:
+        return first
+    return min(first, second)
+
+
+class Sketch(object):
+    """Mergeable percentile sketch with a bounded relative error
+    Values are counted in logarithmically sized bins, the sign is kept in the
+    sign of the bin index and values close to zero share bin 0
+    :param accuracy: float, relative accuracy of the reported percentiles
+    """
+
+    def __init__(self, accuracy=0.01):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        # shifts the bin index of the smallest tracked value above 0
+        self.shift = int(math.ceil(-math.log(MIN_VALUE) / self.log_gamma)) + 1
+
+    def add(self, bins, value, count=1):
+        """Count a value into bins
+        :param bins: dict, bin index -> count
+        :param value: float, value to count
+        :param count: int, number of times to count it
+        :return: None
+        """
+        if abs(value) < MIN_VALUE:
+            index = 0
+        else:
+            index = int(math.ceil(math.log(abs(value)) / self.log_gamma)) + \
+                self.shift
+            if value < 0:
+                index = -index
+        bins[index] = bins.get(index, 0) + count
+
+    def value(self, index):
+        """Representative value of a bin
+        :param index: int, bin index
+        :return: float
+        """
+        if index == 0:
+            return 0.0
+        mag = 2 * self.gamma ** (abs(index) - self.shift) / (self.gamma + 1)
+        return mag if index > 0 else -mag
+
+    def percentile(self, bins, pct):
+        """Estimate a percentile from bins
+        :param bins: dict, bin index -> count
+        :param pct: float, percentile between 0 and 100
+        :return: float or None if the bins are empty
+        """
+        total = sum(bins.values())
+        if not total:
+            return None
+        rank = pct / 100.0 * (total - 1)
+        seen = 0
+        for index in sorted(bins, key=self.value):
+            seen += bins[index]
+            if seen > rank:
+                return self.value(index)
+        return self.value(max(bins, key=self.value))
+
+
+class Retention(object):
+    """Rolls the raw records of the server database into downsampled tiers
+    The tiers live in their own shelf so ingest only ever waits for the raw
+    shelf. Both are expected to be opened with writeback, the cache holds
+    the working set and every key changed by a pass is written back on its
+    own, so the database lock is only held for one batch or one write of a
+    single key at a time. Call run on a thread
+    :param shelf: shelve, raw records, shared with the writers
+    :param lock: threading.Lock, guards shelf
+    :param tier_shelf: shelve, downsampled tiers
+    :param tier_lock: threading.Lock, guards tier_shelf
+    :param raw_window: int, seconds raw records are kept
+    :param tiers: sequence of (interval, keep), bucket size in seconds and
+                  seconds the tier is kept before rolling into the next one.
+                  A keep of None keeps the tier forever, a keep on the last
+                  tier drops its buckets. Every interval must be a multiple
+                  of the previous one
+    :param period: float, seconds between passes
+    :param batch: int, maximum records or buckets handled per lock hold
+    """
+
+    tier_tag = '_Tier'
+    performance_tag = '_Performance'
+    clock_tag = '_Clock'
+    # keys in the raw shelf that do not hold records
+    meta_tags = (clock_tag, '_Sequence')
+
+    def __init__(self, shelf, lock, tier_shelf, tier_lock, raw_window=3600,
+                 tiers=((60, 86400), (3600, None)), period=10.0, batch=500):
+        if not tiers:
+            raise ValueError("At least one tier is required")
+        for (interval, _), (next_interval, _) in zip(tiers, tiers[1:]):
+            if next_interval % interval:
+                raise ValueError("Tier interval %s is not a multiple of %s" %
+                                 (next_interval, interval))
+        for _, keep in tiers[:-1]:
+            if keep is None:
+                raise ValueError("Only the last tier can be kept forever")
+        self.shelf = shelf
+        self.lock = lock
+        self.tier_shelf = tier_shelf
+        self.tier_lock = tier_lock
+        self.raw_window = raw_window
+        self.tiers = tuple(tiers)
+        self.period = period
+        self.batch = batch
+        self.sketch = Sketch()
+        # raw key -> record count when it was last written back
+        self.flushed = {}
+        self.stopped = threading.Event()
+        # held for the duration of a pass
+        self.running = threading.Lock()
+
+    def run(self):
+        """
+        Compact the database every period until stopped. A failed pass is
+        logged and retried on the next period
+        :return: None
+        """
+        try:
+            while not self.stopped.wait(self.period):
+                with self.running:
+                    try:
+                        self.compact(time.time())
+                    except Exception:
+                        logging.exception("Retention pass failed")
+        except KeyboardInterrupt:
+            pass
+        logging.info("Retention stopped")
+
+    def stop(self):
+        """
+        Stop run and wait for a pass in progress to finish, call before
+        closing the shelves
+        :return: None
+        """
+        self.stopped.set()
+        with self.running:
+            pass
+
+    def compact(self, now):
+        """One incremental pass over every raw key
+        :param now: float, current server time
+        :return: None
+        """
+        with self.lock:
+            keys = self.shelf.keys()
+        # clock key -> (sent, received) of the oldest raw record using it
+        oldest = dict((key, (None, None)) for key in keys
+                      if key.endswith(self.clock_tag))
+        for key in keys:
+            if self.stopped.is_set():
+                return
+            if key.endswith(self.meta_tags):
+                continue
+            self.roll_raw(key, now)
+            self.roll_tiers(key, now)
+            clock_key = self.clock_key(key)
+            sent, received = self.oldest_record(key)
+            before = oldest.get(clock_key, (None, None))
+            oldest[clock_key] = (earliest(before[0], sent),
+                                 earliest(before[1], received))
+        for clock_key, (sent, received) in oldest.items():
+            self.prune_clock(clock_key, sent, received)
+
+    def clock_key(self, key):
+        """
+        :param key: string, raw key in the database
+        :return: string, key of the clock snapshots of the client
+        """
+        return key.split(self.performance_tag)[0] + self.clock_tag
+
+    def oldest_record(self, key):
+        """
+        :param key: string, raw key in the database
+        :return: (float, float), sent and received of the oldest timed raw
+                 record of key, None for either when there is none
+        """
+        with self.lock:
+            for record in self.shelf.get(key) or []:
+                if self.timestamp(record) is not None:
+                    return (to_number(record.get("sent")),
+                            to_number(record.get("received")))
+        return None, None
+
+    def prune_clock(self, clock_key, sent, received):
+        """Drop the clock snapshots no raw record can be mapped with any
+        more, the ones covering client time before the oldest raw record was
+        sent or taken more than a raw window before it arrived (a client
+        restart starts its clock over). The newest snapshot is always kept
+        :param clock_key: string, key of the clock snapshots
+        :param sent: float, client send time of the oldest raw record
+        :param received: float, server receive time of the oldest raw record
+        :return: None
+        """
+        with self.lock:
+            snapshots = self.shelf.get(clock_key)
+            if not isinstance(snapshots, list) or len(snapshots) < 2:
+                return
+            kept = [snap for snap in snapshots[:-1]
+                    if snap.get("last") is not None and
+                    (sent is None or snap["last"] >= sent) and
+                    (received is None or
+                     snap.get("taken", received) >=
+                     received - self.raw_window) and
+                    (sent is not None or received is not None)]
+            kept.append(snapshots[-1])
+            if len(kept) < len(snapshots):
+                self.shelf[clock_key] = kept
+
+    def tier_key(self, key, interval):
+        """
+        :param key: string, raw key in the database
+        :param interval: int, bucket size of the tier
+        :return: string, tier shelf key of the tier
+        """
+        return key + self.tier_tag + str(interval)
+
+    def get_tier(self, key, interval):
+        """Fetch a tier, creating it if needed. Must hold the tier lock
+        :return: dict, bucket start -> bucket
+        """
+        t_key = self.tier_key(key, interval)
+        if t_key not in self.tier_shelf:
+            self.tier_shelf[t_key] = {}
+        return self.tier_shelf[t_key]
+
+    @staticmethod
+    def timestamp(record):
+        """
+        :param record: dict, raw record
+        :return: float, server time of the record or None if it has none
+        """
+        if not isinstance(record, dict):
+            return None
+        stamp = to_number(record.get("server_time"))
+        if stamp is None:
+            stamp = to_number(record.get("received"))
+        return stamp
+
+    def roll_raw(self, key, now):
+        """Roll the raw records of key older than the raw window into the
+        first tier. The tier is written before the trimmed records so a
+        crash in between duplicates records rather than losing them
+        :param key: string, raw key in the database
+        :param now: float, current server time
+        :return: None
+        """
+        cutoff = now - self.raw_window
+        interval = self.tiers[0][0]
+        clock_key = self.clock_key(key)
+        with self.lock:
+            snapshots = list(self.shelf.get(clock_key) or [])
+        # latest client time any snapshot covers
+        settled = max([snap["last"] for snap in snapshots if "last" in snap]
+                      or [None])
+        skip = 0  # records without a time stay at the head
+        trimmed = False
+        done = False
+        while not done:
+            rolled = []
+            with self.lock:
+                records = self.shelf.get(key)
+                if not isinstance(records, list):
+                    return
+                untimed = []
+                end = skip
+                done = True
+                for record in records[skip:skip + self.batch]:
+                    stamp = self.timestamp(record)
+                    if stamp is not None and (
+                            stamp >= cutoff or
+                            not self.settled(record, stamp, settled, cutoff)):
+                        break
+                    end += 1
+                    if stamp is None:
+                        untimed.append(record)
+                    else:
+                        rolled.append(record)
+                else:
+                    done = end - skip < self.batch
+                records[skip:end] = untimed
+                skip += len(untimed)
+                trimmed = trimmed or bool(rolled)
+            if rolled:
+                with self.tier_lock:
+                    tier = self.get_tier(key, interval)
+                    for record in rolled:
+                        stamp = self.remap(record, snapshots)
+                        self.add_record(tier, stamp - stamp % interval,
+                                        record)
+                    self.tier_shelf[self.tier_key(key, interval)] = tier
+        self.flush(key, trimmed)
+
+    def settled(self, record, stamp, settled, cutoff):
+        """Whether the clock estimate for a record has settled, a snapshot
+        taken after it was sent exists or the record is too old to wait for
+        one
+        :param record: dict, raw record
+        :param stamp: float, server time of the record
+        :param settled: float, latest client time covered by a snapshot,
+                        None if the client has no snapshots
+        :param cutoff: float, server time raw records are rolled before
+        :return: bool
+        """
+        if settled is None or to_number(record.get("sent")) is None:
+            return True
+        return record["sent"] <= settled or stamp < cutoff - self.raw_window
+
+    def remap(self, record, snapshots):
+        """Re-map the send time of a record with the clock snapshots, the
+        estimate made when it arrived may have been based on a few samples
+        :param record: dict, raw record
+        :param snapshots: list of dicts, clock snapshots of the client
+        :return: float, server time of the record
+        """
+        sent = to_number(record.get("sent"))
+        received = to_number(record.get("received"))
+        server_time = None
+        if snapshots and sent is not None:
+            server_time = map_to_server(snapshots, sent, received)
+        if server_time is not None:
+            record["server_time"] = server_time
+            if received is not None:
+                record["delay"] = received - server_time
+        return self.timestamp(record)
+
+    def flush(self, key, trimmed=False):
+        """Write the raw records of key back if they changed since the last
+        write, new records are only in the writeback cache until then
+        :param key: string, raw key in the database
+        :param trimmed: bool, records were rolled out of key, the length
+                        alone misses a pass that rolls as many as arrived
+        :return: None
+        """
+        with self.lock:
+            records = self.shelf.get(key)
+            if not isinstance(records, list) or (
+                    not trimmed and self.flushed.get(key) == len(records)):
+                return
+            self.shelf[key] = records
+            self.flushed[key] = len(records)
+
+    def roll_tiers(self, key, now):
+        """Roll buckets older than their tier's retention into the next tier
+        or drop them from the last one
+        :param key: string, raw key in the database
+        :param now: float, current server time
+        :return: None
+        """
+        for index, (interval, keep) in enumerate(self.tiers):
+            if keep is None:
+                return
+            cutoff = now - keep
+            if index + 1 < len(self.tiers):
+                next_interval = self.tiers[index + 1][0]
+            else:
+                next_interval = None
+            done = False
+            while not done:
+                with self.tier_lock:
+                    if self.tier_key(key, interval) not in self.tier_shelf:
+                        break
+                    tier = self.get_tier(key, interval)
+                    old = [start for start in tier
+                           if start + interval <= cutoff][:self.batch]
+                    done = len(old) < self.batch
+                    if not old:
+                        break
+                    if next_interval is not None:
+                        coarse = self.get_tier(key, next_interval)
+                        for start in old:
+                            self.merge(coarse, start - start % next_interval,
+                                       tier[start])
+                        self.tier_shelf[self.tier_key(key, next_interval)] = \
+                            coarse
+                    for start in old:
+                        del tier[start]
+                    self.tier_shelf[self.tier_key(key, interval)] = tier
+
+    def add_record(self, tier, start, record):
+        """Count the numeric fields of a raw record into a bucket
+        :param tier: dict, bucket start -> bucket
+        :param start: float, start of the bucket
+        :param record: dict, raw record
+        :return: None
+        """
+        bucket = tier.setdefault(start, {"count": 0, "fields": {}})
+        bucket["count"] += 1
+        # keep the client time span so the bucket can be placed again later
+        sent = to_number(record.get("sent"))
+        if sent is not None:
+            bucket["sent_min"] = min(bucket.get("sent_min", sent), sent)
+            bucket["sent_max"] = max(bucket.get("sent_max", sent), sent)
+        for name, value in record.items():
+            if name in SKIP_FIELDS:
+                continue
+            number = to_number(value)
+            if number is None:
+                continue
+            field = bucket["fields"].setdefault(
+                name, {"count": 0, "min": number, "max": number, "sum": 0.0,
+                       "bins": {}})
+            field["count"] += 1
+            field["min"] = min(field["min"], number)
+            field["max"] = max(field["max"], number)
+            field["sum"] += number
+            self.sketch.add(field["bins"], number)
+
+    @staticmethod
+    def merge(tier, start, bucket):
+        """Merge a bucket into the bucket at start of a coarser tier
+        :param tier: dict, bucket start -> bucket
+        :param start: float, start of the coarser bucket
+        :param bucket: dict, bucket to merge
+        :return: None
+        """
+        if start not in tier:
+            tier[start] = bucket
+            return
+        into = tier[start]
+        into["count"] += bucket["count"]
+        if "sent_min" in bucket:
+            into["sent_min"] = min(into.get("sent_min", bucket["sent_min"]),
+                                   bucket["sent_min"])
+            into["sent_max"] = max(into.get("sent_max", bucket["sent_max"]),
+                                   bucket["sent_max"])
+        for name, field in bucket["fields"].items():
+            if name not in into["fields"]:
+                into["fields"][name] = field
+                continue
+            target = into["fields"][name]
+            target["count"] += field["count"]
+            target["min"] = min(target["min"], field["min"])
+            target["max"] = max(target["max"], field["max"])
+            target["sum"] += field["sum"]
+            for index, count in field["bins"].items():
+                target["bins"][index] = target["bins"].get(index, 0) + count
+
+    def summarize(self, bucket):
+        """
+        :param bucket: dict, bucket from a tier
+        :return: dict, count, client send time span and
+                 min/max/mean/percentiles of every field
+        """
+        fields = {}
+        for name, field in bucket["fields"].items():
+            summary = {"min": field["min"], "max": field["max"],
+                       "mean": field["sum"] / field["count"]}
+            for pct in PERCENTILES:
+                value = self.sketch.percentile(field["bins"], pct)
+                # the bin value is only within the accuracy of the data
+                summary["p%d" % pct] = min(max(value, field["min"]),
+                                           field["max"])
+            fields[name] = summary
+        summary = {"count": bucket["count"], "fields": fields}
+        if "sent_min" in bucket:
+            summary["sent"] = (bucket["sent_min"], bucket["sent_max"])
+        return summary
+
+    def query(self, key, start, end):
+        """Everything stored for key between start and end
+        :param key: string, raw key in the database
+        :param start: float, server time
+        :param end: float, server time
+        :return: (list of (bucket start, interval, summary), list of raw
+                 records), buckets sorted by start
+        """
+        buckets = []
+        with self.tier_lock:
+            for interval, _ in self.tiers:
+                t_key = self.tier_key(key, interval)
+                if t_key not in self.tier_shelf:
+                    continue
+                for b_start, bucket in self.tier_shelf[t_key].items():
+                    if b_start + interval > start and b_start < end:
+                        buckets.append((b_start, interval,
+                                        self.summarize(bucket)))
+        with self.lock:
+            raw = [record for record in self.shelf.get(key, [])
+                   if start <= (self.timestamp(record) or start - 1) < end]
+        buckets.sort()
+        return buckets, raw
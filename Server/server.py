@@ -3,6 +3,14 @@ Server module that contains the Server class.
 Writes all incoming reports from clients to a 'database'.
 Logs incoming reports, heartbeats, performance stats, client connection
 timeouts, and runtime.
+Every stored record gets the server receive time. Records stamped by the
+client are also mapped onto the server timeline using a per client clock
+estimate built from the heartbeats. Snapshots of every clock model are
+appended to "<id>_Clock" as the heartbeats come in and at shutdown, records
+are re-mapped with them when they are downsampled.
+Raw records are kept for a configurable window, older ones are rolled into
+downsampled tiers ("<id>_Tier<seconds>" in "<database>_tiers") by a
+background Retention thread.
 Server will wait 30 seconds for an initial client to connect before shutting
 down. Once all clients have disconnected the server will wait another 30
 seconds in case another client attempts to connect
@@ -11,18 +19,26 @@ __author__ = 'dayling'
 
 from tcp_server import TCPServer
 from hb_listener import HeartBeatListener
+from clock_sync import ClockEstimator, SequenceTracker
+from retention import Retention, to_number
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 import shelve
 import thread
+import threading
 import time
 import multiprocessing
 import json
+import math
 import anydbm
 import logging
 import logging.handlers
 import cProfile
 import pstats
 
+# heartbeats between two snapshots of a client clock model, less than the
+# fit history so consecutive snapshots overlap
+CLOCK_SNAPSHOT = 32
+
 
 class Server(object):
     """
@@ -30,13 +46,15 @@ class Server(object):
     """
 
     def __init__(self, mc_listen_addr, mc_listen_port, tcp_port, db_location,
-                 log_location):
+                 log_location, raw_window=3600):
         """
         :param mc_listen_addr: string, multicast address
         :param mc_listen_port: int, multlicast port
         :param tcp_port: int, port to accept tcp connections
         :param db_location: string, database (shelf) location
         :param log_location: string, log file location
+        :param raw_window: int, seconds raw records are kept before they are
+                           downsampled
         """
         # create a log file for the server
         logging.basicConfig(filename=log_location,
@@ -44,18 +62,33 @@ class Server(object):
                             level=logging.INFO)
 
         self.client_list = []
+        # client id -> ClockEstimator, fed by the heartbeats
+        self.clocks = {}
+        # client id -> SequenceTracker of the tcp reports
+        self.tcp_sequences = {}
         # While a python shelve is technically a true database, it provides
         # enough functionality without requiring
         # any additional dependencies and is fairly useful for this application
         # Ensure the shelf is not already open
+        # The downsampled tiers are kept in a second shelf so the retention
+        # thread never holds up the writers while saving them
         try:
-            self.server_shelf = shelve.open(db_location, writeback=True)
+            self.server_shelf = shelve.open(db_location, protocol=2,
+                                            writeback=True)
+            self.tier_shelf = shelve.open(db_location+'_tiers', protocol=2,
+                                          writeback=True)
         except anydbm.error:
             e_message = "Server Database is open somewhere else, " \
                         "please close it and restart server"
             print e_message
             logging.error(e_message)
             exit(0)
+        # the shelves are shared by the listeners and the retention thread
+        self.db_lock = threading.Lock()
+        self.tier_lock = threading.Lock()
+        self.retention = Retention(self.server_shelf, self.db_lock,
+                                   self.tier_shelf, self.tier_lock,
+                                   raw_window)
 
         # Start the TCPClient listening on available host address
         s_tcp = TCPServer('', tcp_port)
@@ -66,9 +99,9 @@ class Server(object):
 
         # Start the UDP Heartbeat listener
         s_hb = HeartBeatListener(mc_listen_addr, mc_listen_port)
-        hb_queue = multiprocessing.Queue()
+        self.hb_queue = multiprocessing.Queue()
         self.s_hb_proc = multiprocessing.Process(target=s_hb.rec_data,
-                                                 args=(hb_queue, ))
+                                                 args=(self.hb_queue, ))
         self.s_hb_proc.daemon = True
 
     def run_server(self):
@@ -82,9 +115,11 @@ class Server(object):
         :return: None
         """
         self.s_hb_proc.start()
+        thread.start_new_thread(self.hb_monitor, (self.hb_queue, ))
 
         self.s_tcp_proc.start()
         thread.start_new_thread(self.tcp_listener, (self.tcp_queue, ))
+        thread.start_new_thread(self.retention.run, ())
         try:
             # wait for clients to connect
             while True:
@@ -98,7 +133,16 @@ class Server(object):
             shutdown_m = "Server shutting down"
             print shutdown_m
             logging.info(shutdown_m)
-            self.server_shelf.close()
+            # the retention thread must be done with the shelves first
+            self.retention.stop()
+            for c_id in self.clocks.keys():
+                self.save_clock(c_id)
+            with self.db_lock:
+                for c_id, sequence in self.tcp_sequences.items():
+                    self.server_shelf[c_id+'_Sequence'] = sequence.summary()
+                self.server_shelf.close()
+            with self.tier_lock:
+                self.tier_shelf.close()
             return
 
     def tcp_listener(self, data_queue):
@@ -110,7 +154,7 @@ class Server(object):
         :return: none
         """
         while True:
-            message, c_ip = data_queue.get()
+            message, c_ip, received = data_queue.get()
             if message is None:
                 print "Removing Client", c_ip[0], c_ip[1]
                 try:
@@ -123,7 +167,7 @@ class Server(object):
             logging.info(log_string)
             # ensure multiple messages are written individually
             for s_message in message.split('}{'):
-                self.write_db(s_message)
+                self.write_db(s_message, received)
             if c_ip not in self.client_list:
                 self.client_list.append(c_ip)
                 print 'New Client Connected!'
@@ -133,21 +177,104 @@ class Server(object):
             #  client that connects to the server on this port would break
             # the server
 
-    def write_db(self, message):
+    def hb_monitor(self, data_queue):
+        """
+        Process the heartbeats sent from the process running the multicast
+        listener. Logs them and feeds the clock estimate of the client
+        :param data_queue: Queue(), heartbeat data from the listener process
+        :return: none
+        """
+        while True:
+            message, received = data_queue.get()
+            self.udp_data(message)
+            try:
+                beat = json.loads(message)["heartbeat"]
+                c_id = str(beat["id"])
+                seq, sent = int(beat["seq"]), float(beat["sent"])
+                if math.isinf(sent) or math.isnan(sent):
+                    raise ValueError("send time is not finite")
+            except (ValueError, KeyError, TypeError, OverflowError):
+                # int() of an Infinity/NaN seq raises OverflowError
+                logging.warning("Unrecognized heartbeat: " + repr(message))
+                continue
+            if c_id not in self.clocks:
+                self.clocks[c_id] = ClockEstimator()
+                if not beat.get("monotonic", True):
+                    logging.warning("Client " + c_id + " has no monotonic "
+                                    "clock, a step of its wall clock will "
+                                    "show up as an offset jump")
+            self.clocks[c_id].add_sample(seq, sent, received)
+            if self.clocks[c_id].samples % CLOCK_SNAPSHOT == 0:
+                self.save_clock(c_id)
+
+    def save_clock(self, c_id):
+        """Append a snapshot of the clock model of a client to the database
+        :param c_id: string, client id
+        :return: None
+        """
+        snapshot = self.clocks[c_id].summary()
+        snapshot["taken"] = time.time()
+        with self.db_lock:
+            snapshots = self.server_shelf.get(c_id+'_Clock')
+            if not isinstance(snapshots, list):
+                snapshots = []
+            snapshots.append(snapshot)
+            self.server_shelf[c_id+'_Clock'] = snapshots
+
+    def write_db(self, message, received=None):
         """Decode the json message
         Write the incoming message to the database/shelve by checking the id in
         the message to the keys in the shelve
+        The server receive time is added to the record and, if the client
+        stamped it, its send time on the server timeline and the one way delay
+        in excess of the minimum path delay
+        Gaps, reordering and restarts in the report sequence are logged
         :param message: string, as single json blob
+        :param received: float, server receive time
         :return: None
         """
         message = json.loads(message)
         c_id = str(message.keys()[0])
-        if c_id not in self.server_shelf:
-            self.server_shelf[c_id] = [message[c_id]]
-        else:
-            self.server_shelf[c_id].append(message[c_id])
+        record = message[c_id]
+        if received is not None and isinstance(record, dict):
+            record["received"] = received
+            base_id = c_id.split('_Performance')[0]
+            seq = record.get("seq")
+            if isinstance(seq, (int, long)) and not isinstance(seq, bool):
+                self.track_sequence(base_id, seq)
+            # anything but a finite number is stored as is, unmapped
+            sent = to_number(record.get("sent"))
+            clock = self.clocks.get(base_id)
+            if clock is not None and sent is not None:
+                record["server_time"] = clock.to_server(sent)
+                record["delay"] = clock.delay(sent, received)
+        with self.db_lock:
+            if c_id not in self.server_shelf:
+                self.server_shelf[c_id] = [message[c_id]]
+            else:
+                self.server_shelf[c_id].append(message[c_id])
         return
 
+    def track_sequence(self, c_id, seq):
+        """Check the sequence number of a tcp report for gaps
+        :param c_id: string, client id
+        :param seq: int, sequence number of the report
+        :return: None
+        """
+        if c_id not in self.tcp_sequences:
+            self.tcp_sequences[c_id] = SequenceTracker()
+        sequence = self.tcp_sequences[c_id]
+        lost, reordered = sequence.lost, sequence.reordered
+        if sequence.update(seq):
+            logging.warning("Client " + c_id + " restarted its reports")
+        elif sequence.lost > lost:
+            logging.warning("Client " + c_id + " is missing " +
+                            str(sequence.lost - lost) + " reports before " +
+                            str(seq))
+        elif sequence.reordered > reordered:
+            logging.info("Client " + c_id + " report " + str(seq) +
+                         " arrived out of order")
+
     @staticmethod
     def udp_data(udp_message):
         """Simple callback to log the heartbeats
@@ -169,10 +296,13 @@ if __name__ == "__main__":
                          default='test_db')
     M_PARSE.add_argument('-l', '--log', help='The log file location',
                          default='info_server.log')
+    M_PARSE.add_argument('-r', '--raw_window', type=int,
+                         help='Seconds raw records are kept before they are '
+                              'downsampled', default=3600)
     MAIN_A = M_PARSE.parse_args()
 
     SERVER1 = Server(MAIN_A.hb_address, MAIN_A.hb_port, MAIN_A.tcp_port,
-                     MAIN_A.database, MAIN_A.log)
+                     MAIN_A.database, MAIN_A.log, MAIN_A.raw_window)
 
     PRO = cProfile.Profile()
     PRO.enable()
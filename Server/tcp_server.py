@@ -2,11 +2,12 @@
 Module containing TCPServer class to maintain multiple client connections
 Data only flows to this Server
 Class runs a new thread for every remote connection and provides the data in
-a Queue as (data, (host_ip, port))
+a Queue as (data, (host_ip, port), receive_time)
 """
 __author__ = 'dayling'
 
 import socket
+import time
 import thread
 import logging
 
@@ -53,11 +54,12 @@ class TCPServer(socket.socket):
         try:
             while True:
                 data = client.recv(1024)
+                received = time.time()
                 client_ip = client.getpeername()
                 if data == '':
-                    data_queue.put((None, client_ip))
+                    data_queue.put((None, client_ip, received))
                     return
-                data_queue.put((data, client_ip))
+                data_queue.put((data, client_ip, received))
         except KeyboardInterrupt:
             logging.warning("Server stopped while receiving TCP data")
             return
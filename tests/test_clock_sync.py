@@ -0,0 +1,83 @@
+"""
+Tests for the clock offset/drift estimator of the server
+"""
+__author__ = 'dayling'
+
+import random
+import unittest
+
+from Server.clock_sync import ClockEstimator, SequenceTracker
+
+
+def server_time(sent, offset=1000.0, drift=50e-6):
+    """Server time of a client timestamp for a synthetic clock"""
+    return sent + offset + drift * sent
+
+
+class ClockEstimatorTest(unittest.TestCase):
+    """ClockEstimator against synthetic send/receive pairs"""
+
+    def test_exact_offset_and_drift(self):
+        clock = ClockEstimator()
+        for seq in range(1, 100):
+            sent = seq * 5.0
+            clock.add_sample(seq, sent, server_time(sent) + 0.002)
+        self.assertAlmostEqual(clock.drift, 50e-6, delta=1e-9)
+        # the constant path delay is part of the one way offset
+        self.assertAlmostEqual(clock.to_server(300.0),
+                               server_time(300.0) + 0.002, delta=1e-6)
+        self.assertAlmostEqual(clock.delay(300.0, server_time(300.0) + 0.01),
+                               0.008, delta=1e-6)
+
+    def test_jitter_is_filtered(self):
+        rand = random.Random(7)
+        clock = ClockEstimator()
+        for seq in range(1, 300):
+            sent = seq * 5.0
+            clock.add_sample(seq, sent, server_time(sent) + 0.002 +
+                             rand.expovariate(1000))
+        self.assertAlmostEqual(clock.drift, 50e-6, delta=2e-6)
+        self.assertAlmostEqual(clock.to_server(1400.0),
+                               server_time(1400.0) + 0.002, delta=0.001)
+
+    def test_no_samples(self):
+        clock = ClockEstimator()
+        self.assertIsNone(clock.to_server(1.0))
+        self.assertIsNone(clock.delay(1.0, 2.0))
+
+    def test_restart_drops_old_samples(self):
+        clock = ClockEstimator()
+        for seq in range(1, 10):
+            clock.add_sample(seq, seq * 5.0, seq * 5.0 + 100)
+        for seq in range(1, 5):
+            clock.add_sample(seq, 1000 + seq * 5.0, 2000 + seq * 5.0)
+        summary = clock.summary()
+        self.assertEqual(summary["lost"], 0)
+        self.assertEqual(summary["reordered"], 0)
+        self.assertEqual(summary["restarts"], 1)
+        self.assertAlmostEqual(clock.to_server(1030.0), 2030.0)
+
+
+class SequenceTrackerTest(unittest.TestCase):
+    """SequenceTracker gap, reorder and restart counting"""
+
+    def test_gap_then_late_message(self):
+        sequence = SequenceTracker()
+        for seq in (1, 2, 5, 3):
+            self.assertFalse(sequence.update(seq))
+        self.assertEqual(sequence.summary(),
+                         {"lost": 1, "reordered": 1, "restarts": 0})
+
+    def test_restart(self):
+        sequence = SequenceTracker(max_reorder=4)
+        for seq in range(1, 20):
+            sequence.update(seq)
+        self.assertTrue(sequence.update(10))
+        self.assertFalse(sequence.update(11))
+        self.assertTrue(sequence.update(1))
+        self.assertEqual(sequence.summary(),
+                         {"lost": 0, "reordered": 0, "restarts": 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
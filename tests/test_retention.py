@@ -0,0 +1,260 @@
+"""
+Tests for the retention and downsampling of the server database
+"""
+__author__ = 'dayling'
+
+import copy
+import os
+import pickle
+import random
+import shelve
+import shutil
+import tempfile
+import threading
+import unittest
+
+from Server.clock_sync import ClockEstimator
+from Server.retention import Retention, Sketch, to_number
+
+
+def retention(**kwargs):
+    """Retention over plain dicts standing in for the shelves"""
+    return Retention({}, threading.Lock(), {}, threading.Lock(), **kwargs)
+
+
+class ToNumberTest(unittest.TestCase):
+    """Record values to floats"""
+
+    def test_units(self):
+        self.assertEqual(to_number('1.5GB/s'), 1.5e9)
+        self.assertEqual(to_number('52428800.0bytes/sec'), 52428800.0)
+        self.assertEqual(to_number(' 12.5 '), 12.5)
+        self.assertEqual(to_number(3), 3.0)
+
+    def test_not_numbers(self):
+        for value in (None, True, 'fast', [], float('inf'), float('nan'),
+                      '1e999'):
+            self.assertIsNone(to_number(value))
+
+
+class SketchTest(unittest.TestCase):
+    """Percentile sketch error bounds"""
+
+    def test_relative_error(self):
+        rand = random.Random(3)
+        sketch = Sketch(accuracy=0.01)
+        for values in ([rand.lognormvariate(10, 2) for _ in range(5000)],
+                       [-rand.expovariate(0.1) for _ in range(5000)]):
+            bins = {}
+            for value in values:
+                sketch.add(bins, value)
+            values.sort()
+            for pct in (1, 50, 90, 99):
+                exact = values[int(pct / 100.0 * (len(values) - 1))]
+                estimate = sketch.percentile(bins, pct)
+                self.assertLessEqual(abs(estimate - exact),
+                                     0.01 * abs(exact) + 1e-12)
+
+    def test_zero_and_empty(self):
+        sketch = Sketch()
+        self.assertIsNone(sketch.percentile({}, 50))
+        bins = {}
+        for value in (0.0, 0.0, 5.0):
+            sketch.add(bins, value)
+        self.assertEqual(sketch.percentile(bins, 50), 0.0)
+
+
+class BucketTest(unittest.TestCase):
+    """Bucket building, merging and summaries"""
+
+    def setUp(self):
+        rand = random.Random(5)
+        self.records = [{"received": 7200 + i * 2.5, "sent": i * 2.5,
+                         "cpu": str(rand.uniform(0, 100)),
+                         "write_speed": '%fMB/s' % rand.gauss(100, 10)}
+                        for i in range(1440)]
+
+    def test_merge_matches_direct(self):
+        ret = retention()
+        fine, direct = {}, {}
+        for record in self.records:
+            stamp = record["received"]
+            ret.add_record(fine, stamp - stamp % 60, record)
+            ret.add_record(direct, stamp - stamp % 3600, record)
+        coarse = {}
+        for start, bucket in copy.deepcopy(fine).items():
+            ret.merge(coarse, start - start % 3600, bucket)
+        self.assertEqual(sorted(coarse), sorted(direct))
+        for start in direct:
+            merged, built = coarse[start], direct[start]
+            self.assertEqual(merged["count"], built["count"])
+            self.assertEqual(merged["sent_min"], built["sent_min"])
+            self.assertEqual(merged["sent_max"], built["sent_max"])
+            for name, field in built["fields"].items():
+                other = merged["fields"][name]
+                self.assertEqual(other["bins"], field["bins"])
+                self.assertEqual(other["count"], field["count"])
+                self.assertEqual(other["min"], field["min"])
+                self.assertEqual(other["max"], field["max"])
+                self.assertAlmostEqual(other["sum"], field["sum"], places=3)
+
+    def test_summary_is_clamped(self):
+        ret = retention()
+        tier = {}
+        for _ in range(10):
+            ret.add_record(tier, 0, {"cpu": "1.0"})
+        summary = ret.summarize(tier[0])["fields"]["cpu"]
+        for name in ("min", "max", "mean", "p50", "p90", "p99"):
+            self.assertEqual(summary[name], 1.0)
+
+
+class ShelfTest(unittest.TestCase):
+    """Retention over real writeback shelves, checking what is on disk"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.shelf = shelve.open(os.path.join(self.path, 'db'), protocol=2,
+                                 writeback=True)
+        self.tier_shelf = shelve.open(os.path.join(self.path, 'db_tiers'),
+                                      protocol=2, writeback=True)
+        self.ret = Retention(self.shelf, threading.Lock(), self.tier_shelf,
+                             threading.Lock(), raw_window=10)
+
+    def tearDown(self):
+        self.shelf.close()
+        self.tier_shelf.close()
+        shutil.rmtree(self.path)
+
+    def on_disk(self, shelf, key):
+        """Value of key in the dbm, bypassing the writeback cache"""
+        return pickle.loads(shelf.dict[key])
+
+    def test_roll_as_many_as_arrived(self):
+        self.shelf["c"] = [{"received": float(t), "cpu": 1}
+                           for t in range(10)]
+        self.ret.compact(15)
+        self.assertEqual([record["received"]
+                          for record in self.on_disk(self.shelf, "c")],
+                         [5.0, 6.0, 7.0, 8.0, 9.0])
+        # as many new records arrive as the next pass rolls
+        self.shelf["c"].extend({"received": float(t), "cpu": 1}
+                               for t in range(10, 15))
+        self.ret.compact(20)
+        self.assertEqual([record["received"]
+                          for record in self.on_disk(self.shelf, "c")],
+                         [10.0, 11.0, 12.0, 13.0, 14.0])
+        tier = self.on_disk(self.tier_shelf, "c_Tier60")
+        self.assertEqual(tier[0.0]["count"], 10)
+
+
+class RollTest(unittest.TestCase):
+    """Rolling raw records and tiers"""
+
+    def test_roll_raw_batches_and_untimed(self):
+        ret = retention(raw_window=100, batch=3)
+        records = [{"note": "a"}] + \
+            [{"received": float(t), "cpu": 1} for t in range(5)] + \
+            [{"note": "b"}] + \
+            [{"received": float(t), "cpu": 2} for t in range(5, 7)] + \
+            [{"received": 150.0 + t, "cpu": 3} for t in range(3)]
+        ret.shelf["c"] = records
+        ret.roll_raw("c", 200)
+        self.assertEqual(ret.shelf["c"],
+                         [{"note": "a"}, {"note": "b"}] +
+                         [{"received": 150.0 + t, "cpu": 3}
+                          for t in range(3)])
+        tier = ret.tier_shelf["c_Tier60"]
+        self.assertEqual(tier.keys(), [0.0])
+        self.assertEqual(tier[0.0]["count"], 7)
+        self.assertEqual(tier[0.0]["fields"]["cpu"]["sum"], 9.0)
+        # a second pass finds nothing new to roll
+        ret.roll_raw("c", 200)
+        self.assertEqual(len(ret.shelf["c"]), 5)
+        self.assertEqual(ret.tier_shelf["c_Tier60"][0.0]["count"], 7)
+
+    def test_roll_tiers(self):
+        ret = retention(raw_window=0, tiers=((60, 3600), (3600, 86400)),
+                        batch=7)
+        ret.shelf["c"] = [{"received": float(t), "cpu": 1}
+                          for t in range(0, 7200, 30)]
+        ret.compact(7200 + 1800)
+        fine = ret.tier_shelf["c_Tier60"]
+        coarse = ret.tier_shelf["c_Tier3600"]
+        self.assertEqual(sorted(fine), [5400.0 + m * 60 for m in range(30)])
+        self.assertEqual(sorted(coarse), [0.0, 3600.0])
+        self.assertEqual(coarse[0.0]["count"], 120)
+        self.assertEqual(coarse[3600.0]["count"], 60)
+        # the last tier drops its buckets once they are older than keep
+        ret.compact(7200 + 86400 + 3600)
+        self.assertEqual(ret.tier_shelf["c_Tier3600"], {})
+        self.assertEqual(ret.tier_shelf["c_Tier60"], {})
+
+    def test_remap_with_clock_snapshots(self):
+        clock = ClockEstimator()
+        snapshots = []
+        for seq in range(1, 100):
+            sent = seq * 5.0
+            clock.add_sample(seq, sent, 1000 + sent * (1 + 1e-4))
+            if seq % 32 == 0:
+                snapshots.append(clock.summary())
+        ret = retention(raw_window=100)
+        ret.shelf["c_Clock"] = snapshots
+        # stamped at ingest by an estimate that was off by 3 seconds, the
+        # last one was sent after the latest snapshot
+        ret.shelf["c_Performance"] = [
+            {"sent": 100.0, "received": 1100.01, "server_time": 1103.0},
+            {"sent": 490.0, "received": 1490.06, "server_time": 1490.06}]
+        ret.compact(1500)
+        self.assertEqual(ret.shelf["c_Performance"][0]["sent"], 490.0)
+        bucket = ret.tier_shelf["c_Performance_Tier60"][1080.0]
+        self.assertEqual(bucket["count"], 1)
+        self.assertAlmostEqual(bucket["fields"]["delay"]["min"], 0.0,
+                               delta=1e-6)
+        self.assertEqual((bucket["sent_min"], bucket["sent_max"]),
+                         (100.0, 100.0))
+        # too old to wait for a snapshot any longer
+        ret.compact(1490.06 + 201)
+        self.assertEqual(ret.shelf["c_Performance"], [])
+
+    def test_prune_clock_snapshots(self):
+        ret = retention(raw_window=100)
+        ret.shelf["c_Clock"] = [{"last": last, "taken": 1000 + last,
+                                 "offset": 1000.0}
+                                for last in (100.0, 200.0, 300.0, 400.0)]
+        ret.shelf["o_Clock"] = [{"last": 1.0}, {"last": 2.0}]
+        # both raw keys of a client share its snapshots
+        ret.shelf["c"] = [{"sent": 250.0, "received": 1250.0}]
+        ret.shelf["c_Performance"] = [{"sent": 150.0, "received": 1150.0}]
+        ret.compact(1200)
+        self.assertEqual([snap["last"] for snap in ret.shelf["c_Clock"]],
+                         [200.0, 300.0, 400.0])
+        # a client without raw records keeps only its newest snapshot
+        self.assertEqual(ret.shelf["o_Clock"], [{"last": 2.0}])
+        # after a restart the client clock starts over, old snapshots are
+        # dropped once they were taken a raw window before the oldest record
+        ret.shelf["c"] = [{"sent": 5.0, "received": 1600.0}]
+        ret.shelf["c_Performance"] = []
+        ret.shelf["c_Clock"].append({"last": 10.0, "taken": 1601.0})
+        ret.compact(1610)
+        self.assertEqual([snap["last"] for snap in ret.shelf["c_Clock"]],
+                         [10.0])
+
+    def test_failed_pass_does_not_stop_run(self):
+        ret = retention(period=0.01)
+        passes = []
+
+        def compact(now):
+            passes.append(now)
+            raise ValueError("invalid operation on closed shelf")
+        ret.compact = compact
+        thread = threading.Thread(target=ret.run)
+        thread.start()
+        while len(passes) < 3:
+            thread.join(0.01)
+        ret.stop()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()